@@ -1,137 +1,376 @@
 '''Create a COVID-19 safe desk use schedule for Cornell CS'''
 
 from collections import defaultdict, namedtuple
-from csv import DictReader, DictWriter
-from itertools import product
-from json import load as load_json
-from math import floor, sqrt
+from concurrent.futures import ProcessPoolExecutor
+from csv import DictReader, writer
+from math import sqrt
+from os import cpu_count
 
 from fire import Fire  # type: ignore
-from yaml import FullLoader
+from numba import njit  # type: ignore
+from numpy import array, empty, int32
+from orjson import loads as load_json
 from yaml import load as load_yaml
-from z3 import And, Bool, If, Not, Optimize, Sum, Xor, sat  # type: ignore
-from fpdf import FPDF, HTMLMixin
+from z3 import (  # type: ignore
+    AtMost, BitVecSort, Consts, Extract, If, Implies, Int, Optimize, Or, Sum, Z3Exception,
+    get_param, is_true, sat, set_param, unsat
+)
+from fpdf import FPDF
 
-BlockVar = namedtuple('BlockVar', 'b v')
+try:
+  from yaml import CSafeLoader as SafeLoader
+except ImportError:
+  from yaml import SafeLoader  # type: ignore
 
+BlockVar = namedtuple('BlockVar', 'student desk b office v')
 
-class PDF(FPDF, HTMLMixin):
-  pass
+
+class DeskInfo:
+  '''The office, floor, and centroid coordinates of a desk, parsed from a row of the desk data'''
+  __slots__ = ('office', 'floor_num', 'x', 'y')
+
+  def __init__(self, row):
+    self.office = int(row['office'])
+    self.floor_num = self.office // 100
+    self.x = float(row['x'])
+    self.y = float(row['y'])
+
+
+@njit(cache=True)
+def find_conflicts(coords, safety_distance):
+  '''
+  Find the pairs of desks within the safety distance of each other. Takes as arguments:
+    coords: An (N, 2) array giving the coordinates of the centroid of each desk
+    safety_distance: The minimum allowable distance between occupied desks
+  Returns: A (K, 2) array of the indices into coords of each conflicting pair of desks
+  '''
+  num_desks = coords.shape[0]
+  conflicts = empty((num_desks * (num_desks - 1) // 2, 2), dtype=int32)
+  num_conflicts = 0
+  for i in range(num_desks):
+    for j in range(i + 1, num_desks):
+      dx = coords[j, 0] - coords[i, 0]
+      dy = coords[j, 1] - coords[i, 1]
+      if sqrt(dx * dx + dy * dy) < safety_distance:
+        conflicts[num_conflicts, 0] = i
+        conflicts[num_conflicts, 1] = j
+        num_conflicts += 1
+
+  return conflicts[:num_conflicts]
+
+
+def conflict_cliques(conflict_graph):
+  '''
+  Find the maximal cliques of a desk conflict graph with the Bron-Kerbosch algorithm. Takes as
+  arguments:
+    conflict_graph: A dictionary mapping each desk to the set of desks within the safety distance
+    of it
+  Returns: A list of sets of desks, at most one of which may be occupied at any time
+  '''
+  cliques = []
+
+  def expand(clique, candidates, excluded):
+    if not candidates and not excluded:
+      if clique:
+        cliques.append(clique)
+
+      return
+
+    pivot = max(candidates | excluded, key=lambda desk: len(conflict_graph[desk]))
+    for desk in candidates - conflict_graph[pivot]:
+      expand(clique | {desk}, candidates & conflict_graph[desk], excluded & conflict_graph[desk])
+      candidates = candidates - {desk}
+      excluded = excluded | {desk}
+
+  expand(set(), set(conflict_graph), set())
+  return cliques
 
 
 def create_schedule(desk_data, requests, problem_parameters):
   '''
   Compute a desk use schedule. Takes as arguments:
-        desk_data: A dictionary giving for each desk a unique ID, its office number, and coordinates
-        of its centroid
+        desk_data: A dictionary mapping each desk's unique ID to a DeskInfo giving its office
+        number, floor, and coordinates of its centroid
         requests: A list of dictionaries giving each student request with student name, assigned
         desk, and list of available time blocks
         problem_parameters: A dictionary giving the safety distance to be used, the office density
-        cap, the floor density cap, and the list of time blocks
+        cap, the floor density cap, the list of time blocks, and optionally the maximum amount by
+        which the density caps may be relaxed if no schedule meets them
      Returns: A dictionary with assignments of students to time blocks and desks, and a dictionary
      with the same information per office
   '''
-  # Make variables for each desk at each time block where the corresponding student is available
   print('Creating model...')
+  # Merge repeated requests by a student for the same desk, so that each (student, desk) pair gets
+  # a single schedule covering every block in which the student is available
+  requested_blocks = defaultdict(set)
+  for request in requests:
+    requested_blocks[(request['student_name'], request['desk'])].update(request['available_times'])
+
+  # Make a bit-vector for each request with one bit per time block, set when the student is
+  # assigned to their desk for that block, and refer to each available block through its bit
+  blocks = sorted(set().union(*requested_blocks.values()))
+  if not blocks:
+    print('Failure! No time blocks were requested')
+    return None
+
+  block_bits = {block: bit for bit, block in enumerate(blocks)}
+  num_blocks = len(blocks)
+  unavailable_masks = []
+  desk_schedules = defaultdict(list)
+  var_table = []
   desk_vars = defaultdict(list)
   student_vars = defaultdict(list)
-  office_vars = defaultdict(list)
-  floor_vars = defaultdict(list)
+  office_block_vars = defaultdict(list)
+  floor_block_vars = defaultdict(list)
   print('Creating variables...')
-  for request in requests:
-    desk = request['desk']
-    office = desk_data[desk]['office']
-    floor_num = floor(int(office) / 100)
-    student = request['student_name']
+  # Allocate every schedule at once, sharing a single bit-vector sort. The names are passed as a
+  # list since student names may contain spaces
+  schedules = Consts(
+      [f'{student}/{desk}' for student, desk in requested_blocks], BitVecSort(num_blocks)
+  )
+  for ((student, desk), available_times), schedule in zip(requested_blocks.items(), schedules):
+    office = desk_data[desk].office
+    floor_num = desk_data[desk].floor_num
+    available_times = sorted(available_times)
+    available_mask = sum(1 << block_bits[block] for block in available_times)
+    unavailable_masks.append((schedule, ~available_mask & ((1 << num_blocks) - 1)))
+    desk_schedules[desk].append(schedule)
     block_vars = [
-        BlockVar(block, Bool(f'{student}/{desk}/{block}')) for block in request['available_times']
+        BlockVar(
+            student, desk, block, office,
+            Extract(block_bits[block], block_bits[block], schedule) == 1
+        ) for block in available_times
     ]
+    var_table.extend(block_vars)
     desk_vars[desk].extend(block_vars)
     student_vars[student].extend(block_vars)
-    office_vars[office].extend(block_vars)
-    floor_vars[floor_num].extend(block_vars)
+    for block_var in block_vars:
+      office_block_vars[(office, block_var.b)].append(block_var.v)
+      floor_block_vars[(floor_num, block_var.b)].append(block_var.v)
 
-  # Make variables for the number of time blocks assigned to each student
+  # Make expressions for the number of time blocks assigned to each student, used in the objective
   count_vars = {}
   for student in student_vars:
     count_vars[student] = Sum([If(block_var.v, 1, 0) for block_var in student_vars[student]])
 
-  # Make the solver
   solver = Optimize()
 
   print('Adding constraints...')
-  # Add constraint that each student is assigned at least one block
-  for student, counter in count_vars.items():
-    solver.add(counter >= 1)
-
-  # Add mutual exclusion constraints for desks within safety distance of each other
-  for desk_1, desk_2 in product(desk_vars.keys(), desk_vars.keys()):
-    if desk_1 == desk_2:
-      continue
-
-    room1 = desk_data[desk_1]['office']
-    room2 = desk_data[desk_2]['office']
+  # Add constraint that students are only assigned blocks in which they are available
+  for schedule, unavailable_mask in unavailable_masks:
+    solver.add(schedule & unavailable_mask == 0)
 
-    if room1 != room2:
+  # Add constraint that each student is assigned at least one block
+  for block_vars in student_vars.values():
+    solver.add(Or([block_var.v for block_var in block_vars]))
+
+  # Add mutual exclusion constraints for desks within safety distance of each other. Only desks in
+  # the same office can conflict, so compare desks office by office
+  desks_by_office = defaultdict(list)
+  for desk in desk_vars:
+    desks_by_office[desk_data[desk].office].append(desk)
+
+  conflict_graph = defaultdict(set)
+  for desks in desks_by_office.values():
+    coords = array([(desk_data[desk].x, desk_data[desk].y) for desk in desks])
+    for i, j in find_conflicts(coords, problem_parameters['safety_distance']):
+      conflict_graph[desks[i]].add(desks[j])
+      conflict_graph[desks[j]].add(desks[i])
+
+  # Allow at most one of a group of schedules to be set in each time block, i.e. no schedule may
+  # share a set bit with the schedules before it
+  def add_exclusive(schedules):
+    occupied = schedules[0]
+    for schedule in schedules[1:]:
+      solver.add(occupied & schedule == 0)
+      occupied = occupied | schedule
+
+  # At most one student may use a desk in each time block. Desks in a conflict clique are covered
+  # by the clique constraints below, which include all of the schedules on each desk
+  for desk, schedules in desk_schedules.items():
+    if len(schedules) > 1 and desk not in conflict_graph:
+      add_exclusive(schedules)
+
+  # At most one desk in each clique of mutually conflicting desks may be occupied per time block
+  for clique in conflict_cliques(conflict_graph):
+    add_exclusive([schedule for desk in clique for schedule in desk_schedules[desk]])
+
+  # Break symmetries between interchangeable desks, i.e. desks in the same office and position
+  # requested by the same students for the same time blocks, by requiring that they be occupied in
+  # order of desk ID
+  equivalent_desks = defaultdict(list)
+  for desk, block_vars in desk_vars.items():
+    info = desk_data[desk]
+    requested = frozenset((block_var.student, block_var.b) for block_var in block_vars)
+    equivalent_desks[(info.office, info.x, info.y, requested)].append(desk)
+
+  for desks in equivalent_desks.values():
+    if len(desks) < 2:
       continue
 
-    x_1 = float(desk_data[desk_1]['x'])
-    y_1 = float(desk_data[desk_1]['y'])
-    x_2 = float(desk_data[desk_2]['x'])
-    y_2 = float(desk_data[desk_2]['y'])
-
-    dist = sqrt((x_2 - x_1)**2 + (y_2 - y_1)**2)
-    if dist < problem_parameters['safety_distance']:
-      for block_var_1, block_var_2 in product(desk_vars[desk_1], desk_vars[desk_2]):
-        if block_var_1.b == block_var_2.b:
-          solver.add(
-              Xor(Xor(block_var_1.v, block_var_2.v), And(Not(block_var_1.v), Not(block_var_2.v)))
-          )
-
-  # Add office density constraints
-  for office, occupancy_vars in office_vars.items():
-    office_block_counters = defaultdict(list)
-    for occupancy_var in occupancy_vars:
-      office_block_counters[occupancy_var.b].append(If(occupancy_var.v, 1, 0))
-
-    for block in office_block_counters.values():
-      solver.add(Sum(block) <= problem_parameters['office_occupancy_cap'])
-
-  # Add floor density constraints
-  for floor_num, occupancy_vars in floor_vars.items():
-    floor_block_counters = defaultdict(list)
-    for occupancy_var in occupancy_vars:
-      floor_block_counters[occupancy_var.b].append(If(occupancy_var.v, 1, 0))
-
-    for block in floor_block_counters.values():
-      solver.add(Sum(block) <= problem_parameters['floor_occupancy_cap'])
-
-  # Solve, optimizing for minimal difference in number of time slots assigned
-  def abs(x):
-    return If(x >= 0, x, -x)
-
-  avg = Sum(list(count_vars.values())) / len(student_vars)
-  diffs = [abs(avg - counter) for counter in count_vars.values()]
-  solver.maximize(Sum(list(count_vars.values())) - Sum(diffs))
-  print('Attempting to solve model...')
-  if solver.check() == sat:
-    print('Success! Extracting schedule...')
-    model = solver.model()
-    # Extract the schedule of assignments
-    student_schedules = defaultdict(list)
-    office_schedules = defaultdict(list)
-    for var_name in model:
-      student, desk, block = var_name.name().split('/')
-      desk = int(desk)
-      block = int(block)
-      office = desk_data[desk]['office']
-      if model[var_name]:
-        student_schedules[student].append((office, desk, block))
-        office_schedules[office].append((student, desk, block))
-    return student_schedules, office_schedules
-
-  print('Failure! No solution')
-  return None
+    desk_occupancy = {}
+    for desk in desks:
+      desk_occupancy[desk] = defaultdict(list)
+      for block_var in desk_vars[desk]:
+        desk_occupancy[desk][block_var.b].append(block_var.v)
+
+    desks.sort()
+    for desk_1, desk_2 in zip(desks, desks[1:]):
+      for block, occupants in desk_occupancy[desk_2].items():
+        solver.add(Implies(Or(occupants), Or(desk_occupancy[desk_1][block])))
+
+  # Bound the number of time blocks assigned to any one student, for use in the objective
+  max_count = Int('max_count')
+  min_count = Int('min_count')
+  for counter in count_vars.values():
+    solver.add(max_count >= counter, min_count <= counter)
+
+  # Configure the solver through Z3's global parameters, which older versions of Z3 require for
+  # Optimize, and restore their previous values once solving is done. Disable relevancy propagation,
+  # which slows down incremental solving across push/pop frames, and spread the search across all
+  # available cores. Optimize's support for parallelism is limited (only its SMT core runs
+  # cube-and-conquer), so fall back to a sequential solve if this version of Z3 rejects any of the
+  # parallel configuration
+  num_threads = cpu_count() or 1
+  solver_params = {
+      'smt.auto_config': False,
+      'smt.relevancy': 0,
+  }
+  parallel_params = {
+      'parallel.enable': True,
+      'parallel.threads.max': num_threads,
+  }
+  previous_params = {name: get_param(name) for name in [*solver_params, *parallel_params]}
+  try:
+    for name, value in solver_params.items():
+      set_param(name, value)
+
+    try:
+      for name, value in parallel_params.items():
+        set_param(name, value)
+
+      solver.set('threads', num_threads)
+    except Z3Exception:
+      print('Parallel solving unavailable; using a single thread')
+      for name in parallel_params:
+        set_param(name, previous_params[name])
+
+    # Add the density constraints and objective in their own frame, so that if they cannot be met
+    # they can be retracted and retried with relaxed occupancy caps without rebuilding the model
+    for relaxation in range(problem_parameters.get('max_cap_relaxation', 0) + 1):
+      if relaxation:
+        print(f'Retrying with occupancy caps relaxed by {relaxation}...')
+
+      solver.push()
+      # Add office density constraints
+      office_cap = problem_parameters['office_occupancy_cap'] + relaxation
+      for occupancy_vars in office_block_vars.values():
+        solver.add(AtMost(*occupancy_vars, office_cap))
+
+      # Add floor density constraints
+      floor_cap = problem_parameters['floor_occupancy_cap'] + relaxation
+      for occupancy_vars in floor_block_vars.values():
+        solver.add(AtMost(*occupancy_vars, floor_cap))
+
+      # Solve, maximizing the total number of time blocks assigned and then minimizing the
+      # difference between the most and fewest time blocks assigned to any one student
+      solver.maximize(Sum(list(count_vars.values())))
+      solver.minimize(max_count - min_count)
+      print('Attempting to solve model...')
+      result = solver.check()
+      if result == sat:
+        break
+
+      if result != unsat:
+        # The solver gave up (e.g. it hit a resource limit or was interrupted), so relaxing the caps
+        # would not help
+        print(f'Failure! Solver returned unknown: {solver.reason_unknown()}')
+        return None
+
+      solver.pop()
+    else:
+      print('Failure! No solution')
+      return None
+  finally:
+    for name, value in previous_params.items():
+      set_param(name, value)
+
+  print('Success! Extracting schedule...')
+  model = solver.model()
+  # Extract the schedule of assignments
+  student_schedules = defaultdict(list)
+  office_schedules = defaultdict(list)
+  for student, desk, block, office, v in var_table:
+    if is_true(model.eval(v, model_completion=True)):
+      student_schedules[student].append((office, desk, block))
+      office_schedules[office].append((student, desk, block))
+  return student_schedules, office_schedules
+
+
+def render_student_pdf(student, assignments):
+  '''
+  Write the PDF of a single student's desk use assignments. Takes as arguments:
+    student: The name of the student
+    assignments: A list of (office, desk, block) assignments for the student
+  '''
+  title = f'Desk use assignments for {student}'
+  pdf = FPDF()
+  pdf.add_page()
+  pdf.set_xy(0.0, 0.0)
+  pdf.set_font('Arial', 'B', 20)
+  pdf.cell(ln=2, w=210.0, h=10.0, align='C', txt=title)
+  pdf.set_title(title)
+  pdf.set_font('Arial', '', 12)
+  desk_blocks = defaultdict(list)
+  for office, desk, block in assignments:
+    desk_blocks[(office, desk)].append(block)
+
+  for office_desk in desk_blocks:
+    office, desk = office_desk
+    pdf.cell(
+        ln=1,
+        h=10,
+        w=210.0,
+        align='C',
+        txt=f'You may use your desk ({desk}, in Room {office}) during the following time blocks:'
+    )
+
+    # '\x95' is the bullet character in the core fonts' encoding
+    for block in desk_blocks[(office, desk)]:
+      pdf.cell(ln=1, h=6, w=210.0, txt=f'  \x95 block {block}')
+
+  pdf.output(f'{student}.pdf', 'F')
+
+
+def render_office_pdf(office, assignments):
+  '''
+  Write the PDF of a single office's desk use assignments. Takes as arguments:
+    office: The room number of the office
+    assignments: A list of (student, desk, block) assignments for the office
+  '''
+  title = f'Desk use assignments for Room {office}\n'
+  pdf = FPDF()
+  pdf.add_page()
+  pdf.set_xy(0.0, 0.0)
+  pdf.set_font('Arial', 'B', 20)
+  pdf.write(h=10, txt=title)
+  pdf.set_title(title)
+  pdf.set_font('Arial', '', 12)
+  block_occupancy = defaultdict(list)
+  for student, desk, block in assignments:
+    block_occupancy[block].append((student, desk))
+
+  for block in block_occupancy:
+    pdf.set_font('Arial', 'B', 12)
+    pdf.write(h=10, txt=f'Allowed usage for block {block}: ')
+    pdf.set_font('Arial', '', 12)
+    pdf.write(
+        h=10,
+        txt=', '.join([f'{student} at desk {desk}' for student, desk in block_occupancy[block]])
+        + '\n'
+    )
+
+  pdf.output(f'{office}.pdf', 'F')
 
 
 def output(schedule, output_file, make_pdfs):
@@ -143,71 +382,20 @@ def output(schedule, output_file, make_pdfs):
     make_pdfs: A boolean signifying whether or not to generate (2) and (3)
   '''
   student_schedules, office_schedules = schedule
-  output_writer = DictWriter(output_file, fieldnames=['student', 'office', 'desk', 'block'])
+  output_writer = writer(output_file)
   print('Writing full CSV schedule...')
-  output_writer.writeheader()
-  for office, assignments in office_schedules.items():
-    for student, desk, block in assignments:
-      output_writer.writerow({'student': student, 'office': office, 'desk': desk, 'block': block})
+  output_writer.writerow(['student', 'office', 'desk', 'block'])
+  output_writer.writerows(
+      (student, office, desk, block) for office, assignments in office_schedules.items()
+      for student, desk, block in assignments
+  )
 
   if make_pdfs:
-    print('Generating student PDFs...')
-    for student, assignments in student_schedules.items():
-      title = f'Desk use assignments for {student}'
-      pdf = PDF()
-      pdf.add_page()
-      pdf.set_xy(0.0, 0.0)
-      pdf.set_font('Arial', 'B', 20)
-      pdf.cell(ln=2, w=210.0, h=10.0, align='C', txt=title)
-      pdf.set_title(title)
-      pdf.set_font('Arial', '', 12)
-      desk_blocks = defaultdict(list)
-      for office, desk, block in assignments:
-        desk_blocks[(office, desk)].append(block)
-
-      for office_desk in desk_blocks:
-        office, desk = office_desk
-        pdf.cell(
-            h=10,
-            w=210.0,
-            align='C',
-            txt=f'You may use your desk ({desk}, in Room {office}) during the following time blocks:'
-        )
-
-        block_list = ['<ul>']
-        for block in desk_blocks[(office, desk)]:
-          block_list.append(f'<li>{block}</li>')
-
-        block_list.append('</ul>')
-        pdf.write_html('\n'.join(block_list))
-
-      pdf.output(f'{student}.pdf', 'F')
-
-    print('Generating office PDFs...')
-    for office, assignments in office_schedules.items():
-      title = f'Desk use assignments for Room {office}\n'
-      pdf = PDF()
-      pdf.add_page()
-      pdf.set_xy(0.0, 0.0)
-      pdf.set_font('Arial', 'B', 20)
-      pdf.write(h=10, txt=title)
-      pdf.set_title(title)
-      pdf.set_font('Arial', '', 12)
-      block_occupancy = defaultdict(list)
-      for student, desk, block in assignments:
-        block_occupancy[block].append((student, desk))
-
-      for block in block_occupancy:
-        pdf.set_font('Arial', 'B', 12)
-        pdf.write(h=10, txt=f'Allowed usage for block {block}: ')
-        pdf.set_font('Arial', '', 12)
-        pdf.write(
-            h=10,
-            txt=', '.join([f'{student} at desk {desk}' for student, desk in block_occupancy[block]])
-            + '\n'
-        )
-
-      pdf.output(f'{office}.pdf', 'F')
+    with ProcessPoolExecutor() as executor:
+      print('Generating student PDFs...')
+      list(executor.map(render_student_pdf, student_schedules.keys(), student_schedules.values()))
+      print('Generating office PDFs...')
+      list(executor.map(render_office_pdf, office_schedules.keys(), office_schedules.values()))
 
 
 def main(
@@ -234,12 +422,12 @@ def main(
       make_pdfs: Boolean describing whether the complete (CSV + PDF) output is desired
   '''
   with open(desk_data_filename, newline='') as desk_data_file,\
-      open(requests_filename) as requests_file,\
+      open(requests_filename, 'rb') as requests_file,\
       open(parameters_filename) as parameters_file:
     print('Loading data...')
-    desk_data = {int(row['desk_id']): row for row in DictReader(desk_data_file)}
-    requests = load_json(requests_file)
-    parameters = load_yaml(parameters_file, FullLoader)
+    desk_data = {int(row['desk_id']): DeskInfo(row) for row in DictReader(desk_data_file)}
+    requests = load_json(requests_file.read())
+    parameters = load_yaml(parameters_file, SafeLoader)
     schedules = create_schedule(desk_data, requests, parameters)
 
   if not schedules: